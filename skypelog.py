@@ -20,11 +20,15 @@ import json
 import base64
 import os
 import platform
+import multiprocessing
+import hashlib
+import shutil
 
 
 __all__ = ['SkypeDBB', 'SkypeMsgDBB', 'SkypeMsg',
            'SkypeAccDBB', 'SkypeAcc','SkypeContactDBB', 'SkypeContact',
-           'SkypeChatDBB', 'SkypeChat', 'SkypeChatMemberDBB', 'SkypeChatMember']
+           'SkypeChatDBB', 'SkypeChat', 'SkypeChatMemberDBB', 'SkypeChatMember',
+           'SkypeDBBDelta', 'snapshotdbb', 'restoredbb']
 
 
 class SkypeDBB:
@@ -61,13 +65,14 @@ class SkypeDBB:
         self.f.seek(self.stride * num, os.SEEK_SET)
         return self.parserecord(self.f.read(self.stride))
 
-    def parserecord(self, rec):
-        """Parse record in string 'rec'"""
+    def iterfields(self, rec):
+        """Iterate over (ftype, code, val) fields of record in string 'rec'
+
+        Blob values are returned raw (not base64 encoded).
+        """
         if rec[:4] != 'l33l':
             raise RuntimeError("Invalid header magic %s" % repr(rec[:4]))
-        res = {}
-        recsize, recid = struct.unpack("<II", rec[4:12])
-        res[-1] = recid
+        recsize = struct.unpack("<I", rec[4:8])[0]
         pos = 17
         while pos < recsize + 8:
             ftype = rec[pos]
@@ -84,12 +89,21 @@ class SkypeDBB:
             elif ftype == '\x04':
                 code, pos = self.read7bitnum(rec, pos)
                 bsize, pos = self.read7bitnum(rec, pos)
-                val = base64.b64encode(rec[pos:pos + bsize])
+                val = rec[pos:pos + bsize]
                 pos = pos + bsize
             else:
                 raise RuntimeError("Unknown field type %s at offset %d" %
                                    (hex(ord(ftype)), pos))
+            yield (ftype, code, val)
+
+    def parserecord(self, rec):
+        """Parse record in string 'rec'"""
+        res = {}
+        for ftype, code, val in self.iterfields(rec):
+            if ftype == '\x04':
+                val = base64.b64encode(val)
             res[code] = val
+        res[-1] = struct.unpack("<I", rec[8:12])[0]
         return res
 
     def records(self):
@@ -99,6 +113,22 @@ class SkypeDBB:
             yield self.parserecord(rec)
         raise StopIteration
 
+    def readfile(self):
+        """Return a copy of the whole file taken in one read"""
+        self.f.seek(0, os.SEEK_SET)
+        return self.f.read()
+
+    def blockhashes(self, block=1, data=None):
+        """Return md5 hex digests of every 'block' records in file
+
+        'data' is the file contents, read with readfile() if omitted.
+        """
+        if data is None:
+            data = self.readfile()
+        size = self.stride * block
+        return [hashlib.md5(data[off:off + size]).hexdigest()
+                for off in xrange(0, len(data), size)]
+
     def __init__(self, filename, maxsize=0):
         """Open .dbb file with record size 'maxsize' (optional)"""
         if maxsize == 0:
@@ -401,6 +431,213 @@ class SkypeChatMember(SkypeObject):
     __slots__ = FIELD_NAMES.values()
 
 
+class SkypeDBBDelta:
+    """Changed blocks of a DBB file relative to a hash manifest
+
+    Delta file layout: 'l33d' magic, header (baseline id, sequence number,
+    stride, block, old file size, file size, number of blocks) and for each
+    changed block its index, length and data.
+
+    Hashes are compared per block, so with block > 1 every record of a
+    changed block is reported, not only the records that changed.
+    """
+
+    MAGIC = 'l33d'
+    HEADER = "<8sIIIIII"
+    BLOCK = "<II"
+
+    def __init__(self, filename=None):
+        """Read delta from 'filename' (optional)"""
+        self.baseline = ''
+        self.seq = 0
+        self.stride = 0
+        self.block = 1
+        self.oldlen = 0
+        self.flen = 0
+        self.blocks = []
+        if filename is not None:
+            with open(filename, 'rb') as f:
+                self.parse(f.read())
+
+    def parse(self, data):
+        """Parse delta in string 'data'"""
+        if data[:4] != self.MAGIC:
+            raise RuntimeError("Invalid delta magic %s" % repr(data[:4]))
+        pos = 4 + struct.calcsize(self.HEADER)
+        (baseline, self.seq, self.stride, self.block, self.oldlen, self.flen,
+         nblocks) = struct.unpack(self.HEADER, data[4:pos])
+        self.baseline = baseline.encode('hex')
+        self.blocks = []
+        bsize = struct.calcsize(self.BLOCK)
+        for i in xrange(nblocks):
+            idx, length = struct.unpack(self.BLOCK, data[pos:pos + bsize])
+            pos += bsize
+            self.blocks.append((idx, data[pos:pos + length]))
+            pos += length
+
+    def diff(self, dbb, hashes, block=1, oldlen=0):
+        """Collect blocks of 'dbb' whose hashes differ from 'hashes'
+
+        'oldlen' is the file size the hashes were computed for.
+        Returns new hashes of all blocks, computed in the same pass.
+        """
+        self.stride = dbb.stride
+        self.block = block
+        self.oldlen = oldlen
+        data = dbb.readfile()
+        self.flen = len(data)
+        newhashes = dbb.blockhashes(block, data)
+        size = self.stride * block
+        self.blocks = [(idx, data[idx * size:(idx + 1) * size])
+                       for idx, digest in enumerate(newhashes)
+                       if idx >= len(hashes) or hashes[idx] != digest]
+        return newhashes
+
+    def write(self, filename):
+        """Save delta to 'filename'"""
+        out = [self.MAGIC,
+               struct.pack(self.HEADER, self.baseline.decode('hex'), self.seq,
+                           self.stride, self.block, self.oldlen, self.flen,
+                           len(self.blocks))]
+        for idx, data in self.blocks:
+            out.append(struct.pack(self.BLOCK, idx, len(data)))
+            out.append(data)
+        replacefile(filename, ''.join(out))
+
+    def apply(self, filename):
+        """Patch file 'filename' in place"""
+        size = self.stride * self.block
+        with open(filename, 'r+b') as f:
+            for idx, data in self.blocks:
+                f.seek(idx * size, os.SEEK_SET)
+                f.write(data)
+            f.truncate(self.flen)
+
+    def slots(self):
+        """Iterate over (slot number, raw record) in changed blocks"""
+        for idx, data in self.blocks:
+            for off in xrange(0, len(data), self.stride):
+                rec = data[off:off + self.stride]
+                if rec[:4] == 'l33l':
+                    yield (idx * self.block + off / self.stride, rec)
+
+    def removed(self):
+        """Return list of slot numbers without a record
+
+        These are empty slots in changed blocks and slots cut off
+        because the file got shorter.
+        """
+        res = []
+        for idx, data in self.blocks:
+            for off in xrange(0, len(data), self.stride):
+                if data[off:off + 4] != 'l33l':
+                    res.append(idx * self.block + off / self.stride)
+        nslots = (self.flen + self.stride - 1) / self.stride
+        oldslots = (self.oldlen + self.stride - 1) / self.stride
+        res.extend(xrange(nslots, oldslots))
+        return res
+
+    def recids(self):
+        """Return list of record ids of records in changed blocks"""
+        return [struct.unpack("<I", rec[8:12])[0] for num, rec in self.slots()]
+
+    def records(self, dbb):
+        """Iterate over records in changed blocks parsed by reader 'dbb'"""
+        for num, rec in self.slots():
+            yield dbb.parserecord(rec)
+
+
+def replacefile(filename, data):
+    """Atomically replace contents of 'filename' with string 'data'"""
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmpname, filename)
+
+
+def deltaname(base, seq):
+    """Return file name of delta number 'seq' of snapshot 'base'"""
+    return "%s.%06d.delta" % (base, seq)
+
+
+def loadmanifest(base):
+    """Return manifest dictionary of snapshot 'base' or None"""
+    manifest = base + '.manifest'
+    if not os.path.exists(manifest):
+        return None
+    with open(manifest, 'rb') as f:
+        return json.load(f)
+
+
+def snapshotdbb(filename, base, block=1):
+    """Back up DBB file 'filename' to snapshot 'base'
+
+    The first run copies the file to 'base' and writes 'base'.manifest
+    with block hashes. Later runs write only changed blocks to
+    'base'.NNNNNN.delta (NNNNNN is a sequence number kept in the manifest)
+    and update the manifest. A full copy removes all old deltas of 'base'.
+    Returns SkypeDBBDelta, or None for a full copy.
+    """
+    dbb = SkypeDBB(filename)
+    old = loadmanifest(base)
+    delta = None
+    if old is not None:
+        if old['stride'] != dbb.stride:
+            raise RuntimeError("Record size of %s changed" % filename)
+        block = old['block']
+        delta = SkypeDBBDelta()
+        hashes = delta.diff(dbb, old['hashes'], block, old['size'])
+        baseline = delta.baseline = old['baseline']
+        basehash = old['basehash']
+        seq = old['seq']
+        size = delta.flen
+        if delta.blocks or delta.flen != old['size']:
+            seq += 1
+            delta.seq = seq
+            delta.write(deltaname(base, seq))
+    else:
+        dirname, prefix = os.path.split(base)
+        prefix += '.'
+        for name in os.listdir(dirname or '.'):
+            if name.startswith(prefix) and name.endswith('.delta'):
+                os.remove(os.path.join(dirname, name))
+        data = dbb.readfile()
+        replacefile(base, data)
+        hashes = dbb.blockhashes(block, data)
+        baseline = os.urandom(8).encode('hex')
+        basehash = hashlib.md5(data).hexdigest()
+        size = len(data)
+        seq = 0
+    replacefile(base + '.manifest',
+                json.dumps({'baseline': baseline, 'basehash': basehash,
+                            'seq': seq, 'stride': dbb.stride, 'block': block,
+                            'size': size, 'hashes': hashes}))
+    return delta
+
+
+def restoredbb(base, filename):
+    """Restore latest state of snapshot 'base' to 'filename'
+
+    Copies the base snapshot and replays its deltas in sequence order.
+    Only deltas of the baseline recorded in the manifest are applied.
+    """
+    manifest = loadmanifest(base)
+    if manifest is None:
+        raise RuntimeError("No manifest for snapshot %s" % base)
+    with open(base, 'rb') as f:
+        if hashlib.md5(f.read()).hexdigest() != manifest['basehash']:
+            raise RuntimeError("Snapshot %s does not match manifest" % base)
+    shutil.copyfile(base, filename)
+    for seq in xrange(1, manifest['seq'] + 1):
+        delta = SkypeDBBDelta(deltaname(base, seq))
+        if delta.baseline != manifest['baseline'] or delta.seq != seq:
+            raise RuntimeError("Delta %s does not belong to snapshot %s"
+                               % (deltaname(base, seq), base))
+        delta.apply(filename)
+
+
 # -----------------------------------------------------------------------------
 # End of API, local functions follow
 # -----------------------------------------------------------------------------
@@ -426,14 +663,45 @@ def forskypedbbs(func, prefix):
             func(user, chatdbbs)
 
 
+SINCE = None
+
+
+def changedrecords(user, dbb, filename):
+    """Iterate over records of 'dbb' changed since snapshot in SINCE
+
+    Returns all records if SINCE is not set or the file has no snapshot.
+    """
+    if SINCE is None:
+        return dbb.records()
+    manifest = loadmanifest(os.path.join(SINCE, user,
+                                         os.path.basename(filename)))
+    if manifest is None:
+        return dbb.records()
+    if manifest['stride'] != dbb.stride:
+        raise RuntimeError("Record size of %s changed" % filename)
+    delta = SkypeDBBDelta()
+    delta.diff(dbb, manifest['hashes'], manifest['block'], manifest['size'])
+    return delta.records(dbb)
+
+
+def jsonname(user):
+    """Return JSON output file name for 'user'
+
+    Changes since a snapshot go to 'user'.since.js to keep the full export.
+    """
+    if SINCE is None:
+        return user + '.js'
+    return user + '.since.js'
+
+
 def dumpmsg_json_full_helper(user, chatdbbs):
     """Dump full messages from 'chatdbbs' files to 'user'.js file (unsorted)"""
-    fname = user + '.js'
+    fname = jsonname(user)
     print "writing %s ..." % fname
     with open(fname, 'wb') as f:
         for filename in chatdbbs:
             msgdbb = SkypeMsgDBB(filename)
-            for r in msgdbb.records():
+            for r in changedrecords(user, msgdbb, filename):
                 f.write(r.json_full() + ",\n")
 
 
@@ -444,12 +712,12 @@ def dumpmsg_json_full():
 
 def dumpmsg_json_compact_helper(user, chatdbbs):
     """Dump messages from 'chatdbbs' files to 'user'.js file (unsorted)"""
-    fname = user + '.js'
+    fname = jsonname(user)
     print "writing %s ..." % fname
     with open(fname, 'wb') as f:
         for filename in chatdbbs:
             msgdbb = SkypeMsgDBB(filename)
-            for r in msgdbb.records():
+            for r in changedrecords(user, msgdbb, filename):
                 f.write(r.json_compact() + ",\n")
 
 
@@ -560,6 +828,148 @@ def dumpmsg_html():
     forskypedbbs(dumpmsg_html_helper, "chatmsg")
 
 
+FIELD_TYPES = {'\x00' : 'int', '\x03' : 'str', '\x04' : 'blob'}
+
+FAMILY_CLASSES = {'chatmsg' : SkypeMsg, 'profile' : SkypeAcc,
+                  'user' : SkypeContact, 'chat' : SkypeChat,
+                  'chatmember' : SkypeChatMember}
+
+CENSUS_EXAMPLES = 3
+CENSUS_EXAMPLE_SIZE = 32
+
+
+def census_file(filename):
+    """Collect field statistics for every record in 'filename'
+
+    Returns (family, nrecords, nempty, nbad, stats), where 'nempty' counts
+    slots without a record, 'nbad' records that failed to parse and 'stats'
+    maps field code to [count, {type: count}, {size bucket: count},
+    [examples]]. String and blob examples are cut to CENSUS_EXAMPLE_SIZE.
+    Integer sizes are counted in 7-bit encoded bytes.
+    Records are parsed with SkypeDBB.iterfields, no record objects are built.
+    """
+    family = os.path.basename(filename)[:-4].rstrip('0123456789')
+    stats = {}
+    nrecords = 0
+    nempty = 0
+    nbad = 0
+    dbb = SkypeDBB(filename)
+    data = dbb.readfile()
+    for off in xrange(0, len(data), dbb.stride):
+        rec = data[off:off + dbb.stride]
+        if rec[:4] != 'l33l':
+            nempty += 1
+            continue
+        try:
+            fields = list(dbb.iterfields(rec))
+        except (RuntimeError, AssertionError, IndexError, struct.error):
+            nbad += 1
+            continue
+        nrecords += 1
+        for ftype, code, val in fields:
+            if ftype == '\x00':
+                size = 1
+                while val >> (7 * size):
+                    size += 1
+            else:
+                size = len(val)
+            bucket = 1
+            while bucket < size:
+                bucket <<= 1
+            if code not in stats:
+                stats[code] = [0, {}, {}, []]
+            st = stats[code]
+            st[0] += 1
+            st[1][ftype] = st[1].get(ftype, 0) + 1
+            st[2][bucket] = st[2].get(bucket, 0) + 1
+            if len(st[3]) < CENSUS_EXAMPLES:
+                if ftype == '\x04':
+                    val = base64.b64encode(val[:CENSUS_EXAMPLE_SIZE])
+                elif ftype == '\x03':
+                    val = val[:CENSUS_EXAMPLE_SIZE]
+                if val not in st[3]:
+                    st[3].append(val)
+    return (family, nrecords, nempty, nbad, stats)
+
+
+def census_merge(total, stats):
+    """Merge field 'stats' of one file into 'total'"""
+    for code, (count, types, sizes, examples) in stats.iteritems():
+        if code not in total:
+            total[code] = [0, {}, {}, []]
+        st = total[code]
+        st[0] += count
+        for key, n in types.iteritems():
+            st[1][key] = st[1].get(key, 0) + n
+        for key, n in sizes.iteritems():
+            st[2][key] = st[2].get(key, 0) + n
+        for val in examples:
+            if len(st[3]) < CENSUS_EXAMPLES and val not in st[3]:
+                st[3].append(val)
+
+
+def census():
+    """Report field codes of every DBB file family for every user"""
+    dbbs = []
+    forskypedbbs(lambda user, names: dbbs.extend(names), "")
+    families = {}
+    pool = multiprocessing.Pool()
+    for family, nrec, nempty, nbad, stats in pool.imap_unordered(census_file,
+                                                                 dbbs):
+        if family not in families:
+            families[family] = [0, 0, 0, 0, {}]
+        fam = families[family]
+        fam[0] += 1
+        fam[1] += nrec
+        fam[2] += nempty
+        fam[3] += nbad
+        census_merge(fam[4], stats)
+    pool.close()
+    pool.join()
+
+    for family in sorted(families.keys()):
+        nfiles, nrec, nempty, nbad, stats = families[family]
+        names = getattr(FAMILY_CLASSES.get(family), 'FIELD_NAMES', {})
+        print ("==== %s: %d files, %d records, %d empty slots, "
+               "%d parse failures" % (family, nfiles, nrec, nempty, nbad))
+        for code in sorted(stats.keys()):
+            count, types, sizes, examples = stats[code]
+            print "%6d %-24s %5.1f%% %s" % (
+                code, names.get(code, '?'),
+                100.0 * count / max(nrec, 1),
+                ','.join("%s:%d" % (FIELD_TYPES[t], n)
+                         for t, n in sorted(types.items())))
+            print "       sizes  %s" % ' '.join(
+                "<=%d:%d" % (b, n) for b, n in sorted(sizes.items()))
+            print "       values %s" % ' '.join(repr(v) for v in examples)
+
+
+def snapshot_helper(user, dbbs):
+    """Back up 'dbbs' files of 'user' to SNAPSHOT_DIR/'user'"""
+    userdir = os.path.join(SNAPSHOT_DIR, user)
+    if not os.path.isdir(userdir):
+        os.makedirs(userdir)
+    for filename in dbbs:
+        base = os.path.join(userdir, os.path.basename(filename))
+        manifest = loadmanifest(base)
+        if (BLOCK is not None and manifest is not None
+                and manifest['block'] != BLOCK):
+            print ("%s: ignoring --block, snapshot uses block %d"
+                   % (base, manifest['block']))
+        delta = snapshotdbb(filename, base, BLOCK or 1)
+        if delta is None:
+            print "%s: full copy" % base
+        else:
+            print ("%s: %d records in %d changed blocks, %d slots removed"
+                   % (base, len(delta.recids()), len(delta.blocks),
+                      len(delta.removed())))
+
+
+def snapshot():
+    """Back up all DBB files for every user"""
+    forskypedbbs(snapshot_helper, "")
+
+
 def usage():
     print """\
 Usage: skypelog [OPTION]...
@@ -571,14 +981,21 @@ Option:
   -t, --html                Save history for user/contact pair in *.html files
   -m, --mode={append,overwrite} HTML output mode (guess by default)
   -l, --limit=bytes[KM]     Limit output html file size
+  -c, --census              Report field codes found in all *.dbb files
+  -s, --snapshot=dir        Back up all *.dbb files to dir, saving only
+                            changed blocks after the first run
+  -b, --block=records       Hash granularity of new snapshots (default 1)
+  -S, --since=dir           With --json save to *.since.js only records in
+                            blocks changed since the last snapshot in dir
 """
     sys.exit()
 
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hj:tm:l:",
-                                   ["help", "json=", "html", "mode=", "limit="])
+        opts, args = getopt.getopt(sys.argv[1:], "hj:tm:l:cs:b:S:",
+                                   ["help", "json=", "html", "mode=", "limit=",
+                                    "census", "snapshot=", "block=", "since="])
     except getopt.GetoptError, err:
         print str(err)
         usage()
@@ -588,9 +1005,14 @@ def main():
 
     global SIZE_LIMIT
     global MODE
+    global SNAPSHOT_DIR
+    global BLOCK
+    global SINCE
     action = []
     SIZE_LIMIT = 1024**3
     MODE = "guess"
+    BLOCK = None
+    SINCE = None
     for op, arg in opts:
         if op in ("-h", "--help"):
             usage()
@@ -607,6 +1029,28 @@ def main():
         elif op in ("-t", "--html"):
             print "Dumping chat history to HTML..."
             action.append('dumpmsg_html')
+        elif op in ("-c", "--census"):
+            print "Collecting field census..."
+            action.append('census')
+        elif op in ("-s", "--snapshot"):
+            print "Saving snapshot to '%s'..." % arg
+            SNAPSHOT_DIR = arg
+            action.append('snapshot')
+        elif op in ("-S", "--since"):
+            if os.path.isdir(arg):
+                SINCE = arg
+                print "Saving only changes since snapshot in '%s'" % SINCE
+            else:
+                print "SINCE: bad argument '%s'" % arg
+                action.append('usage')
+        elif op in ("-b", "--block"):
+            try:
+                BLOCK = int(arg)
+                if BLOCK < 1:
+                    raise ValueError()
+            except ValueError:
+                print "BLOCK: bad argument '%s'" % arg
+                action.append('usage')
         elif op in ("-m", "--mode"):
             if arg in ["append", "overwrite", "guess"]:
                 MODE = arg
@@ -632,6 +1076,14 @@ def main():
         else:
             assert False, "unhandled option"
 
+    if SINCE is not None and action not in (['dumpmsg_json_compact'],
+                                            ['dumpmsg_json_full']):
+        print "SINCE: can only be used with --json"
+        action.append('usage')
+    if BLOCK is not None and action != ['snapshot']:
+        print "BLOCK: can only be used with --snapshot"
+        action.append('usage')
+
     if len(action) == 1:
         globals()[action[0]]()
     else: